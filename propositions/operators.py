@@ -7,9 +7,147 @@
 """Syntactic conversion of propositional formulas to use only specific sets of
 operators."""
 
+from typing import Callable, Mapping, Optional
+
 from propositions.syntax import *
 from propositions.semantics import *
 
+#: Formulas shared by all conversions, used in the expansions of constants and
+#: negations.
+_P = Formula('p')
+_T = Formula('T')
+_F = Formula('F')
+_NOT_P = Formula('~', _P)
+_P_OR_NOT_P = Formula('|', _P, _NOT_P)
+_P_AND_NOT_P = Formula('&', _P, _NOT_P)
+_P_IMPLIES_P = Formula('->', _P, _P)
+_NOT_P_IMPLIES_P = Formula('~', _P_IMPLIES_P)
+_F_IMPLIES_F = Formula('->', _F, _F)
+
+#: Type of functions that rebuild a node of a formula from the already rebuilt
+#: operands of that node (``None`` for operands that the node does not have).
+_Template = Callable[[Optional[Formula], Optional[Formula]], Formula]
+
+def _rebuild(formula: Formula, templates: Mapping[str, _Template]) -> Formula:
+    """Rebuilds the given formula bottom-up, without recursion.
+
+    Parameters:
+        formula: formula to rebuild.
+        templates: mapping from each constant and operator that may occur in
+            the given formula to a function that rebuilds a node with that root
+            from the already rebuilt operands of that node.
+
+    Returns:
+        The rebuilt formula, in which variable names are kept as they are.
+        Every distinct node object of the given formula is rebuilt only once,
+        even if it occurs more than once in the formula.
+    """
+    def rebuild_node(node: Formula, first: Optional[Formula],
+                     second: Optional[Formula]) -> Formula:
+        template = templates.get(node.root)
+        if template is None:
+            assert is_variable(node.root)
+            return node
+        return template(first, second)
+    return formula.rebuild(rebuild_node)
+
+def _hash_consing_constructor() -> Callable[..., Formula]:
+    """Creates a formula constructor that returns a single shared instance for
+    each distinct formula that it is asked to construct.
+
+    Returns:
+        A function that accepts the same arguments as the `Formula`
+        constructor. Given a root and operands that were themselves constructed
+        by this function, it returns the previously constructed formula with
+        that root and those operands, if there is one, and otherwise constructs
+        a new formula.
+    """
+    constructed = {}
+    def construct(root: str, first: Optional[Formula] = None,
+                  second: Optional[Formula] = None) -> Formula:
+        key = (root, id(first), id(second))
+        formula = constructed.get(key)
+        if formula is None:
+            formula = constructed[key] = Formula(root, first, second)
+        return formula
+    return construct
+
+def _fold_constants(formula: Formula) -> Formula:
+    """Simplifies away all constants in the given formula, unless the formula
+    is equivalent to a constant.
+
+    Parameters:
+        formula: formula to simplify.
+
+    Returns:
+        A formula that has the same truth table as the given formula, and that
+        is either a constant or contains no constants. Subformulas that contain
+        no constants are returned as they are.
+    """
+    if formula.operators().isdisjoint({'T', 'F'}):
+        return formula
+    construct = _hash_consing_constructor()
+    def negation(X: Formula) -> Formula:
+        if is_constant(X.root):
+            return _F if X.root == 'T' else _T
+        return construct('~', X)
+    def conjunction(X: Formula, Y: Formula) -> Formula:
+        if X.root == 'F' or Y.root == 'F':
+            return _F
+        if X.root == 'T':
+            return Y
+        if Y.root == 'T':
+            return X
+        return construct('&', X, Y)
+    def disjunction(X: Formula, Y: Formula) -> Formula:
+        if X.root == 'T' or Y.root == 'T':
+            return _T
+        if X.root == 'F':
+            return Y
+        if Y.root == 'F':
+            return X
+        return construct('|', X, Y)
+    def implication(X: Formula, Y: Formula) -> Formula:
+        if is_constant(X.root) or is_constant(Y.root):
+            return disjunction(negation(X), Y)
+        return construct('->', X, Y)
+    def exclusive_disjunction(X: Formula, Y: Formula) -> Formula:
+        if X.root == 'F':
+            return Y
+        if Y.root == 'F':
+            return X
+        if X.root == 'T':
+            return negation(Y)
+        if Y.root == 'T':
+            return negation(X)
+        return construct('+', X, Y)
+    def equivalence(X: Formula, Y: Formula) -> Formula:
+        if is_constant(X.root) or is_constant(Y.root):
+            return negation(exclusive_disjunction(X, Y))
+        return construct('<->', X, Y)
+    def nand(X: Formula, Y: Formula) -> Formula:
+        if is_constant(X.root) or is_constant(Y.root):
+            return negation(conjunction(X, Y))
+        return construct('-&', X, Y)
+    def nor(X: Formula, Y: Formula) -> Formula:
+        if is_constant(X.root) or is_constant(Y.root):
+            return negation(disjunction(X, Y))
+        return construct('-|', X, Y)
+    simplifications = {
+        '~': lambda A, B: negation(A), '&': conjunction, '|': disjunction,
+        '->': implication, '+': exclusive_disjunction, '<->': equivalence,
+        '-&': nand, '-|': nor}
+    def fold(node: Formula, first: Optional[Formula],
+             second: Optional[Formula]) -> Formula:
+        if node.first is None:
+            return node
+        if first is node.first and not is_constant(first.root) and \
+           (second is None or
+            (second is node.second and not is_constant(second.root))):
+            return node
+        return simplifications[node.root](first, second)
+    return formula.rebuild(fold)
+
 def to_not_and_or(formula: Formula) -> Formula:
     """Syntactically converts the given formula to an equivalent formula that
     contains no constants or operators beyond ``'~'``, ``'&'``, and ``'|'``.
@@ -22,35 +160,23 @@ def to_not_and_or(formula: Formula) -> Formula:
         contains no constants or operators beyond ``'~'``, ``'&'``, and
         ``'|'``.
     """
-    if is_variable(formula.root):
-        return Formula(formula.root)
-    if is_constant(formula.root):
-        if formula.root == 'T':
-            return Formula('|', Formula('p'), Formula('~', Formula('p')))
-        return Formula('&', Formula('p'), Formula('~', Formula('p')))
-    if is_unary(formula.root):
-        return Formula('~', to_not_and_or(formula.first))
-    A = to_not_and_or(formula.first)
-    B = to_not_and_or(formula.second)
-    if formula.root == '&':
-        return Formula('&', A, B)
-    if formula.root == '|':
-        return Formula('|', A, B)
-    if formula.root == '->':
-        return Formula('|', Formula('~', A), B)
-    if formula.root == '+':
-        left = Formula('&', A, Formula('~', B))
-        right = Formula('&', Formula('~', A), B)
-        return Formula('|', left, right)
-    if formula.root == '<->':
-        left = Formula('&', A, B)
-        right = Formula('&', Formula('~', A), Formula('~', B))
-        return Formula('|', left, right)
-    if formula.root == '-&':
-        return Formula('~', Formula('&', A, B))
-    if formula.root == '-|':
-        return Formula('~', Formula('|', A, B))
-    return Formula(formula.root, A, B)
+    formula = _fold_constants(formula)
+    construct = _hash_consing_constructor()
+    def negate(X: Formula) -> Formula:
+        return construct('~', X)
+    return _rebuild(formula, {
+        'T': lambda A, B: _P_OR_NOT_P,
+        'F': lambda A, B: _P_AND_NOT_P,
+        '~': lambda A, B: negate(A),
+        '&': lambda A, B: construct('&', A, B),
+        '|': lambda A, B: construct('|', A, B),
+        '->': lambda A, B: construct('|', negate(A), B),
+        '+': lambda A, B: construct('|', construct('&', A, negate(B)),
+                                    construct('&', negate(A), B)),
+        '<->': lambda A, B: construct('|', construct('&', A, B),
+                                      construct('&', negate(A), negate(B))),
+        '-&': lambda A, B: negate(construct('&', A, B)),
+        '-|': lambda A, B: negate(construct('|', A, B))})
     # Task 3.5
 
 def to_not_and(formula: Formula) -> Formula:
@@ -64,18 +190,25 @@ def to_not_and(formula: Formula) -> Formula:
         A formula that has the same truth table as the given formula, but
         contains no constants or operators beyond ``'~'`` and ``'&'``.
     """
-    f = to_not_and_or(formula)
-    if is_variable(f.root) or is_constant(f.root):
-        return Formula(f.root)
-    if is_unary(f.root):
-        return Formula('~', to_not_and(f.first))
-    A = to_not_and(f.first)
-    B = to_not_and(f.second)
-    if f.root == '&':
-        return Formula('&', A, B)
-    if f.root == '|':
-        return Formula('~', Formula('&', Formula('~', A), Formula('~', B)))
-    return Formula(f.root, A, B)
+    formula = _fold_constants(formula)
+    construct = _hash_consing_constructor()
+    def negate(X: Formula) -> Formula:
+        return construct('~', X)
+    def conjoin(X: Formula, Y: Formula) -> Formula:
+        return construct('&', X, Y)
+    return _rebuild(formula, {
+        'T': lambda A, B: negate(_P_AND_NOT_P),
+        'F': lambda A, B: _P_AND_NOT_P,
+        '~': lambda A, B: negate(A),
+        '&': lambda A, B: conjoin(A, B),
+        '|': lambda A, B: negate(conjoin(negate(A), negate(B))),
+        '->': lambda A, B: negate(conjoin(A, negate(B))),
+        '+': lambda A, B: negate(conjoin(negate(conjoin(A, negate(B))),
+                                         negate(conjoin(negate(A), B)))),
+        '<->': lambda A, B: conjoin(negate(conjoin(A, negate(B))),
+                                    negate(conjoin(negate(A), B))),
+        '-&': lambda A, B: negate(conjoin(A, B)),
+        '-|': lambda A, B: conjoin(negate(A), negate(B))})
     # Task 3.6a
 
 def to_nand(formula: Formula) -> Formula:
@@ -89,22 +222,27 @@ def to_nand(formula: Formula) -> Formula:
         A formula that has the same truth table as the given formula, but
         contains no constants or operators beyond ``'-&'``.
     """
-    f = to_not_and(formula)
-    if is_variable(f.root) or is_constant(f.root):
-        return Formula(f.root)
-    if is_unary(f.root):
-        A = to_nand(f.first)
-        return Formula('-&', A, A)
-    A = to_nand(f.first)
-    B = to_nand(f.second)
-    if f.root == '&':
-        nand_ab = Formula('-&', A, B)
-        return Formula('-&', nand_ab, nand_ab)
-    if f.root == '|':
-        na = Formula('-&', A, A)
-        nb = Formula('-&', B, B)
-        return Formula('-&', na, nb)
-    return Formula(f.root, A, B)
+    formula = _fold_constants(formula)
+    construct = _hash_consing_constructor()
+    def nand(X: Formula, Y: Formula) -> Formula:
+        return construct('-&', X, Y)
+    def negate(X: Formula) -> Formula:
+        return nand(X, X)
+    true = nand(_P, negate(_P))
+    def xor(X: Formula, Y: Formula) -> Formula:
+        nand_xy = nand(X, Y)
+        return nand(nand(X, nand_xy), nand(Y, nand_xy))
+    return _rebuild(formula, {
+        'T': lambda A, B: true,
+        'F': lambda A, B: negate(true),
+        '~': lambda A, B: negate(A),
+        '&': lambda A, B: negate(nand(A, B)),
+        '|': lambda A, B: nand(negate(A), negate(B)),
+        '->': lambda A, B: nand(A, negate(B)),
+        '+': lambda A, B: xor(A, B),
+        '<->': lambda A, B: nand(nand(A, B), nand(negate(A), negate(B))),
+        '-&': lambda A, B: nand(A, B),
+        '-|': lambda A, B: negate(nand(negate(A), negate(B)))})
     # Task 3.6b
 
 def to_implies_not(formula: Formula) -> Formula:
@@ -118,36 +256,25 @@ def to_implies_not(formula: Formula) -> Formula:
         A formula that has the same truth table as the given formula, but
         contains no constants or operators beyond ``'->'`` and ``'~'``.
     """
-    if is_variable(formula.root):
-        return Formula(formula.root)
-    if is_constant(formula.root):
-        if formula.root == 'T':
-            return Formula('->', Formula('p'), Formula('p'))
-        return Formula('~', Formula('->', Formula('p'), Formula('p')))
-    if is_unary(formula.root):
-        return Formula('~', to_implies_not(formula.first))
-    A = to_implies_not(formula.first)
-    B = to_implies_not(formula.second)
-    if formula.root == '&':
-        return Formula('~', Formula('->', A, Formula('~', B)))
-    if formula.root == '|':
-        return Formula('->', Formula('~', A), B)
-    if formula.root == '->':
-        return Formula('->', A, B)
-    if formula.root == '<->':
-        leftimp = Formula('->', A, B)
-        rightimp = Formula('->', B, A)
-        return Formula('~', Formula('->', leftimp, Formula('~', rightimp)))
-    if formula.root == '+':
-        leftimp = Formula('->', A, B)
-        rightimp = Formula('->', B, A)
-        eq = Formula('~', Formula('->', leftimp, Formula('~', rightimp)))
-        return Formula('~', eq)
-    if formula.root == '-&':
-        return Formula('->', A, Formula('~', B))
-    if formula.root == '-|':
-        return Formula('~', Formula('->', Formula('~', A), B))
-    return Formula(formula.root, A, B)
+    formula = _fold_constants(formula)
+    construct = _hash_consing_constructor()
+    def negate(X: Formula) -> Formula:
+        return construct('~', X)
+    def implies(X: Formula, Y: Formula) -> Formula:
+        return construct('->', X, Y)
+    def iff(X: Formula, Y: Formula) -> Formula:
+        return negate(implies(implies(X, Y), negate(implies(Y, X))))
+    return _rebuild(formula, {
+        'T': lambda A, B: _P_IMPLIES_P,
+        'F': lambda A, B: _NOT_P_IMPLIES_P,
+        '~': lambda A, B: negate(A),
+        '&': lambda A, B: negate(implies(A, negate(B))),
+        '|': lambda A, B: implies(negate(A), B),
+        '->': lambda A, B: implies(A, B),
+        '+': lambda A, B: negate(iff(A, B)),
+        '<->': lambda A, B: iff(A, B),
+        '-&': lambda A, B: implies(A, negate(B)),
+        '-|': lambda A, B: negate(implies(negate(A), B))})
     # Task 3.6c
 
 def to_implies_false(formula: Formula) -> Formula:
@@ -161,36 +288,23 @@ def to_implies_false(formula: Formula) -> Formula:
         A formula that has the same truth table as the given formula, but
         contains no constants or operators beyond ``'->'`` and ``'F'``.
     """
-    if is_variable(formula.root):
-        return Formula(formula.root)
-    if is_constant(formula.root):
-        if formula.root == 'F':
-            return Formula('F')
-        return Formula('->', Formula('F'), Formula('F'))
-    if is_unary(formula.root):
-        return Formula('->', to_implies_false(formula.first), Formula('F'))
-    A = to_implies_false(formula.first)
-    B = to_implies_false(formula.second)
-    if formula.root == '&':
-        return Formula('->', Formula('->', A, Formula('->', B, Formula('F'))), Formula('F'))
-    if formula.root == '|':
-        return Formula('->', Formula('->', A, Formula('F')), B)
-    if formula.root == '->':
-        return Formula('->', A, B)
-    if formula.root == '<->':
-        leftimp = Formula('->', A, B)
-        rightimp = Formula('->', B, A)
-        return Formula('->', Formula('->', leftimp, Formula('->', rightimp, Formula('F'))), Formula('F'))
-    if formula.root == '+':
-        leftimp = Formula('->', A, B)
-        rightimp = Formula('->', B, A)
-        eq = Formula('->', Formula('->', leftimp, Formula('->', rightimp, Formula('F'))), Formula('F'))
-        return Formula('->', eq, Formula('F'))
-    if formula.root == '-&':
-        and_map = Formula('->', Formula('->', A, Formula('->', B, Formula('F'))), Formula('F'))
-        return Formula('->', and_map, Formula('F'))
-    if formula.root == '-|':
-        or_map = Formula('->', Formula('->', A, Formula('F')), B)
-        return Formula('->', or_map, Formula('F'))
-    return Formula(formula.root, A, B)
+    formula = _fold_constants(formula)
+    construct = _hash_consing_constructor()
+    def implies(X: Formula, Y: Formula) -> Formula:
+        return construct('->', X, Y)
+    def negate(X: Formula) -> Formula:
+        return implies(X, _F)
+    def conjoin(X: Formula, Y: Formula) -> Formula:
+        return negate(implies(X, negate(Y)))
+    return _rebuild(formula, {
+        'T': lambda A, B: _F_IMPLIES_F,
+        'F': lambda A, B: _F,
+        '~': lambda A, B: negate(A),
+        '&': lambda A, B: conjoin(A, B),
+        '|': lambda A, B: implies(negate(A), B),
+        '->': lambda A, B: implies(A, B),
+        '+': lambda A, B: implies(implies(A, B), negate(implies(B, A))),
+        '<->': lambda A, B: conjoin(implies(A, B), implies(B, A)),
+        '-&': lambda A, B: implies(A, negate(B)),
+        '-|': lambda A, B: negate(implies(negate(A), B))})
     # Task 3.6d
@@ -6,6 +6,8 @@
 
 """Tests for the propositions.operators module."""
 
+import sys
+
 from propositions.syntax import *
 from propositions.semantics import *
 from propositions.operators import *
@@ -85,6 +87,17 @@ def test_to_implies_false(debug=False):
                str(ff) + ' contains wrong operators'
         assert is_tautology(Formula('<->', f, ff))
 
+def test_deep_formula_conversion(debug=False):
+    depth = 2 * sys.getrecursionlimit()
+    if debug:
+        print('Testing conversion of a formula nested', depth, 'levels deep.')
+    f = Formula.parse('(' * depth + 'p' + '&~q)' * depth)
+    ff = to_implies_false(f)
+    assert ff.operators().issubset({'->', 'F'}), \
+           'conversion contains wrong operators'
+    for model in all_models(['p', 'q']):
+        assert evaluate(ff, model) == evaluate(f, model)
+
 def test_ex3(debug=False):
     assert is_binary('+'), 'Change is_binary() before testing Chapter 3 tasks.'
     test_operators_defined(debug)
@@ -93,6 +106,7 @@ def test_ex3(debug=False):
     test_to_nand(debug)
     test_to_implies_not(debug)
     test_to_implies_false(debug)
+    test_deep_formula_conversion(debug)
 
 def test_all(debug=False):
     test_ex3(debug)
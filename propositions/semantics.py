@@ -6,7 +6,8 @@
 
 """Semantic analysis of propositional-logic constructs."""
 
-from typing import AbstractSet, Iterable, Iterator, Mapping, Sequence, Tuple
+from typing import AbstractSet, Callable, Iterable, Iterator, Mapping, \
+    Sequence, Tuple
 
 from propositions.syntax import *
 from propositions.proofs import *
@@ -63,29 +64,262 @@ def evaluate(formula: Formula, model: Model) -> bool:
     """
     assert is_model(model)
     assert formula.variables().issubset(variables(model))
-    if is_constant(formula.root):
-        return formula.root == 'T'
-    if is_variable(formula.root):
-        return model[formula.root]
-    if is_unary(formula.root):
-        return not evaluate(formula.first, model)
-    if formula.root == '&':
-        return evaluate(formula.first, model) and evaluate(formula.second, model)
-    if formula.root == '|':
-        return evaluate(formula.first, model) or evaluate(formula.second, model)
-    if formula.root == '->':
-        return (not evaluate(formula.first, model)) or evaluate(formula.second, model)
-    if formula.root == '+':
-        return evaluate(formula.first, model) != evaluate(formula.second, model)
-    if formula.root == '<->':
-        return evaluate(formula.first, model) == evaluate(formula.second, model)
-    if formula.root == '-&':
-        return not (evaluate(formula.first, model) and evaluate(formula.second, model))
-    if formula.root == '-|':
-        return not (evaluate(formula.first, model) or evaluate(formula.second, model))
-    raise ValueError
+    roots, firsts, seconds = formula.flatten()
+    values = []
+    for root, first, second in zip(roots, firsts, seconds):
+        if first < 0:
+            value = root == 'T' if is_constant(root) else model[root]
+        elif second < 0:
+            value = not values[first]
+        else:
+            a = values[first]
+            b = values[second]
+            if root == '&':
+                value = a and b
+            elif root == '|':
+                value = a or b
+            elif root == '->':
+                value = (not a) or b
+            elif root == '+':
+                value = a != b
+            elif root == '<->':
+                value = a == b
+            elif root == '-&':
+                value = not (a and b)
+            elif root == '-|':
+                value = not (a or b)
+            else:
+                raise ValueError
+        values.append(value)
+    return values[-1]
     # Task 2.1
 
+#: Python expression templates computing the truth value of each operator from
+#: the truth values of its operands.
+_OPERATOR_EXPRESSIONS = {'~': 'not {}', '&': '{} and {}', '|': '{} or {}',
+                         '->': '(not {}) or {}', '+': '{} != {}',
+                         '<->': '{} == {}', '-&': 'not ({} and {})',
+                         '-|': 'not ({} or {})'}
+
+def _compile(formula: Formula) -> Callable[[Model], bool]:
+    """Compiles the given formula into a Python function that calculates its
+    truth value in a given model.
+
+    Parameters:
+        formula: formula to compile.
+
+    Returns:
+        A function that, given a model over (possibly a superset of) the
+        variable names of the given formula, returns the truth value of the
+        given formula in that model. The function body is straight-line code
+        with a single assignment per distinct node of the formula, so calling it
+        involves neither recursion nor any dispatch on the formula's operators.
+    """
+    roots, firsts, seconds = formula.flatten()
+    lines = ['def compiled(model):']
+    for position, (root, first, second) in \
+            enumerate(zip(roots, firsts, seconds)):
+        if first < 0:
+            expression = str(root == 'T') if is_constant(root) \
+                else 'model[' + repr(root) + ']'
+        elif second < 0:
+            expression = _OPERATOR_EXPRESSIONS[root].format('v' + str(first))
+        else:
+            expression = _OPERATOR_EXPRESSIONS[root].format(
+                'v' + str(first), 'v' + str(second))
+        lines.append('    v' + str(position) + ' = ' + expression)
+    lines.append('    return v' + str(len(roots) - 1))
+    namespace = {}
+    exec('\n'.join(lines), namespace)
+    return namespace['compiled']
+
+def _variable_bits(index: int, count: int) -> int:
+    """Computes the truth values of a variable in all models over a given number
+    of variables, bit-packed into a single integer.
+
+    Parameters:
+        index: position of the variable among the variables.
+        count: number of variables.
+
+    Returns:
+        An integer whose bit number `i` is set if and only if the variable at
+        the given position is ``True`` in the `i`-th model returned by
+        `all_models`.
+    """
+    half = 1 << (count - 1 - index)
+    period = (1 << (2 * half)) - 1
+    return ((1 << (1 << count)) - 1) // period * (period ^ ((1 << half) - 1))
+
+def _compile_bits(formula: Formula) -> Callable[[Mapping[str, int], int], int]:
+    """Compiles the given formula into a function that calculates its truth
+    values in a sequence of models, given the bit-packed truth values of its
+    variable names in these models.
+
+    Parameters:
+        formula: formula to compile.
+
+    Returns:
+        A function that, given a mapping from each variable name of the given
+        formula to an integer whose bit number `i` is set if and only if that
+        variable name is ``True`` in the `i`-th model, and given an integer
+        whose bits are set exactly at the positions of the models, returns an
+        integer whose bit number `i` is set if and only if the given formula
+        evaluates to ``True`` in the `i`-th model. The function executes a
+        precomputed list of steps, one per distinct node of the formula, each
+        evaluating that node in all models at once by a single bitwise
+        operation. The steps store their results in a small set of registers
+        that are reused once a result is no longer needed, so only the
+        intermediate results that are still needed are kept in memory.
+    """
+    # First pass: how many times each distinct node is used as an operand.
+    roots, firsts, seconds = formula.flatten()
+    uses = [0] * len(roots)
+    for first, second in zip(firsts, seconds):
+        if first >= 0:
+            uses[first] += 1
+        if second >= 0:
+            uses[second] += 1
+    # Second pass: the steps, with registers freed after the last use of the
+    # result that they hold.
+    steps = []
+    registers = []
+    free = []
+    register_count = 0
+    for root, first, second in zip(roots, firsts, seconds):
+        operands = [operand for operand in (first, second) if operand >= 0]
+        sources = [registers[operand] for operand in operands] + \
+                  [None] * (2 - len(operands))
+        for operand in operands:
+            uses[operand] -= 1
+            if uses[operand] == 0:
+                free.append(registers[operand])
+        if len(free) > 0:
+            target = free.pop()
+        else:
+            target = register_count
+            register_count += 1
+        registers.append(target)
+        steps.append((root, target, sources[0], sources[1]))
+    result = registers[-1]
+
+    def compiled(columns: Mapping[str, int], mask: int) -> int:
+        values = [0] * register_count
+        for root, target, first, second in steps:
+            if root == '&':
+                values[target] = values[first] & values[second]
+            elif root == '|':
+                values[target] = values[first] | values[second]
+            elif root == '~':
+                values[target] = mask ^ values[first]
+            elif root == '->':
+                values[target] = (mask ^ values[first]) | values[second]
+            elif root == '+':
+                values[target] = values[first] ^ values[second]
+            elif root == '<->':
+                values[target] = mask ^ values[first] ^ values[second]
+            elif root == '-&':
+                values[target] = mask ^ (values[first] & values[second])
+            elif root == '-|':
+                values[target] = mask ^ (values[first] | values[second])
+            elif root == 'T':
+                values[target] = mask
+            elif root == 'F':
+                values[target] = 0
+            else:
+                values[target] = columns[root]
+        return values[result]
+    return compiled
+
+def _truth_table_bits(formula: Formula, variables: Sequence[str]) -> int:
+    """Calculates the truth values of the given formula in all models over the
+    given variable names, bit-packed into a single integer.
+
+    Parameters:
+        formula: formula to calculate the truth values of.
+        variables: variable names, including all those of the given formula,
+            over which to calculate the truth values.
+
+    Returns:
+        An integer whose bit number `i` is set if and only if the given formula
+        evaluates to ``True`` in the `i`-th model returned by
+        `all_models`\\ ``(``\\ `~_truth_table_bits.variables`\\ ``)``.
+    """
+    columns = {v: _variable_bits(i, len(variables))
+               for i, v in enumerate(variables)}
+    return _compile_bits(formula)(columns, (1 << (1 << len(variables))) - 1)
+
+#: Maximal number of variable names over whose models a formula is evaluated at
+#: once by `_truth_table_blocks`.
+_BLOCK_VARIABLES = 12
+
+def _truth_table_blocks(formula: Formula,
+                        variables: Sequence[str]) -> Iterator[int]:
+    """Lazily calculates the truth values of the given formula in all models
+    over the given variable names, in consecutive blocks of bit-packed models.
+
+    Parameters:
+        formula: formula to calculate the truth values of.
+        variables: variable names, including all those of the given formula,
+            over which to calculate the truth values.
+
+    Returns:
+        An iterator over integers, one per block of consecutive models returned
+        by `all_models`\\ ``(``\\ `~_truth_table_blocks.variables`\\ ``)``,
+        in order. Each block consists of the models over the last (up to)
+        `_BLOCK_VARIABLES` given variable names for a fixed assignment to the
+        other ones, and bit number `i` of its integer is set if and only if the
+        given formula evaluates to ``True`` in the `i`-th model of the block.
+        Callers that stop iterating upon finding a witness avoid evaluating the
+        formula in the remaining blocks.
+    """
+    compiled = _compile_bits(formula)
+    block_count = min(len(variables), _BLOCK_VARIABLES)
+    fixed_count = len(variables) - block_count
+    mask = (1 << (1 << block_count)) - 1
+    columns = {v: _variable_bits(i, block_count)
+               for i, v in enumerate(variables[fixed_count:])}
+    for block in range(1 << fixed_count):
+        for i, v in enumerate(variables[:fixed_count]):
+            columns[v] = mask if (block >> (fixed_count - 1 - i)) & 1 else 0
+        yield compiled(columns, mask)
+
+class _TupleModel(Mapping[str, bool]):
+    """An immutable model backed by a tuple of truth values, for variable names
+    whose positions are shared by all models over the same variable names.
+
+    Attributes:
+        _indices (`~typing.Mapping`\\[`str`, `int`]): mapping from each variable
+            name of the model to the position of its truth value.
+        _values (`~typing.Tuple`\\[`bool`, ...]): the truth values of the
+            variable names of the model, by position.
+    """
+    __slots__ = ('_indices', '_values')
+
+    def __init__(self, indices: Mapping[str, int], values: Tuple[bool, ...]):
+        """Initializes a `_TupleModel` from the given positions of the variable
+        names and truth values.
+
+        Parameters:
+            indices: mapping from each variable name of the model to the
+                position of its truth value.
+            values: the truth values of the variable names of the model, by
+                position.
+        """
+        self._indices = indices
+        self._values = values
+
+    def __getitem__(self, variable: str) -> bool:
+        return self._values[self._indices[variable]]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._indices)
+
+    def __len__(self) -> int:
+        return len(self._indices)
+
+    def __repr__(self) -> str:
+        return repr(dict(zip(self._indices, self._values)))
+
 def all_models(variables: Sequence[str]) -> Iterable[Model]:
     """Calculates all possible models over the given variable names.
 
@@ -105,11 +339,11 @@ def all_models(variables: Sequence[str]) -> Iterable[Model]:
         [{'q': False, 'p': False}, {'q': False, 'p': True}, {'q': True, 'p': False}, {'q': True, 'p': True}]
     """
     from itertools import product
-    from logic_utils import frozendict
     for v in variables:
         assert is_variable(v)
+    indices = {v: i for i, v in enumerate(variables)}
     for values in product([False, True], repeat=len(variables)):
-        yield frozendict(dict(zip(variables, values)))
+        yield _TupleModel(indices, values)
     # Task 2.2
 
 def truth_values(formula: Formula, models: Iterable[Model]) -> Iterable[bool]:
@@ -128,7 +362,8 @@ def truth_values(formula: Formula, models: Iterable[Model]) -> Iterable[bool]:
         >>> list(truth_values(Formula.parse('~(p&q76)'), all_models(['p', 'q76'])))
         [True, True, True, False]
     """
-    return [evaluate(formula, model) for model in models]
+    compiled = _compile(formula)
+    return [compiled(model) for model in models]
     # Task 2.3
 
 def print_truth_table(formula: Formula) -> None:
@@ -148,18 +383,22 @@ def print_truth_table(formula: Formula) -> None:
         | T | T   | F        |
     """
     vars_sorted = sorted(formula.variables())
-    models = list(all_models(vars_sorted))
+    n = len(vars_sorted)
     cols = vars_sorted + [str(formula)]
     header = '| ' + ' | '.join(cols) + ' |'
     sep = '|-' + '-|-'.join(['-' * len(c) for c in cols]) + '-|'
-    print(header)
-    print(sep)
-    for model in models:
-        row = []
-        for v in vars_sorted:
-            row.append('T' if model[v] else 'F')
-        row.append('T' if evaluate(formula, model) else 'F')
-        print('| ' + ' | '.join(f'{cell:<{len(col)}}' for cell, col in zip(row, cols)) + ' |')
+    row_format = '| ' + ' | '.join('{:<' + str(len(c)) + '}' for c in cols) + \
+                 ' |'
+    # Bit strings of '0'/'1' characters become rows of 'F'/'T' cells.
+    to_cells = str.maketrans('01', 'FT')
+    values = format(_truth_table_bits(formula, vars_sorted), 'b') \
+        .zfill(1 << n)[::-1].translate(to_cells)
+    # The binary digits of i | (1 << n), after the leading one, are the values
+    # of the variables in the i-th model.
+    rows = [row_format.format(
+                *format(i | (1 << n), 'b')[1:].translate(to_cells), value)
+            for i, value in enumerate(values)]
+    print('\n'.join([header, sep] + rows))
     # Task 2.4
 
 def is_tautology(formula: Formula) -> bool:
@@ -172,7 +411,9 @@ def is_tautology(formula: Formula) -> bool:
         ``True`` if the given formula is a tautology, ``False`` otherwise.
     """
     vars_sorted = sorted(formula.variables())
-    return all(evaluate(formula, model) for model in all_models(vars_sorted))
+    if len(vars_sorted) == 0:
+        return evaluate(formula, {})
+    return not any(_truth_table_blocks(Formula('~', formula), vars_sorted))
     # Task 2.5a
 
 def is_contradiction(formula: Formula) -> bool:
@@ -185,7 +426,9 @@ def is_contradiction(formula: Formula) -> bool:
         ``True`` if the given formula is a contradiction, ``False`` otherwise.
     """
     vars_sorted = sorted(formula.variables())
-    return not any(evaluate(formula, model) for model in all_models(vars_sorted))
+    if len(vars_sorted) == 0:
+        return not evaluate(formula, {})
+    return not any(_truth_table_blocks(formula, vars_sorted))
     # Task 2.5b
 
 def is_satisfiable(formula: Formula) -> bool:
@@ -198,9 +441,31 @@ def is_satisfiable(formula: Formula) -> bool:
         ``True`` if the given formula is satisfiable, ``False`` otherwise.
     """
     vars_sorted = sorted(formula.variables())
-    return any(evaluate(formula, model) for model in all_models(vars_sorted))
+    if len(vars_sorted) == 0:
+        return evaluate(formula, {})
+    return any(_truth_table_blocks(formula, vars_sorted))
     # Task 2.5c
 
+def _fold(operator: str, operands: Sequence[Formula]) -> Formula:
+    """Combines the given formulas using the given binary operator into a
+    balanced formula tree.
+
+    Parameters:
+        operator: binary operator to combine the formulas with.
+        operands: nonempty sequence of formulas to combine, in order.
+
+    Returns:
+        The given formulas, in the given order, combined pairwise using the
+        given operator into a formula tree of logarithmic depth.
+    """
+    assert is_binary(operator)
+    assert len(operands) > 0
+    while len(operands) > 1:
+        operands = [Formula(operator, operands[i], operands[i + 1])
+                    if i + 1 < len(operands) else operands[i]
+                    for i in range(0, len(operands), 2)]
+    return operands[0]
+
 def _synthesize_for_model(model: Model) -> Formula:
     """Synthesizes a propositional formula in the form of a single conjunctive
     clause that evaluates to ``True`` in the given model, and to ``False`` in
@@ -215,12 +480,8 @@ def _synthesize_for_model(model: Model) -> Formula:
     """
     assert is_model(model)
     assert len(model.keys()) > 0
-    vars_list = list(model.keys())
-    clause = None
-    for v in vars_list:
-        lit = Formula(v) if model[v] else Formula('~', Formula(v))
-        clause = lit if clause is None else Formula('&', clause, lit)
-    return clause
+    return _fold('&', [Formula(v) if model[v] else Formula('~', Formula(v))
+                       for v in model.keys()])
     # Task 2.6
 
 def synthesize(variables: Sequence[str], values: Iterable[bool]) -> Formula:
@@ -246,24 +507,17 @@ def synthesize(variables: Sequence[str], values: Iterable[bool]) -> Formula:
         False
     """
     assert len(variables) > 0
-    models = list(all_models(variables))
-    clauses = []
-    for model, val in zip(models, values):
-        if val:
-            lits = []
-            for v in variables:
-                lits.append(Formula(v) if model[v] else Formula('~', Formula(v)))
-            conj = lits[0]
-            for lit in lits[1:]:
-                conj = Formula('&', conj, lit)
-            clauses.append(conj)
+    n = len(variables)
+    positives = [Formula(v) for v in variables]
+    negatives = [Formula('~', literal) for literal in positives]
+    # Variable number j is True in the i-th model if and only if bit number
+    # n-1-j of i is set.
+    clauses = [_fold('&', [positives[j] if (i >> (n - 1 - j)) & 1
+                           else negatives[j] for j in range(n)])
+               for i, val in zip(range(1 << n), values) if val]
     if not clauses:
-        v = variables[0]
-        return Formula('&', Formula(v), Formula('~', Formula(v)))
-    f = clauses[0]
-    for c in clauses[1:]:
-        f = Formula('|', f, c)
-    return f
+        return Formula('&', positives[0], negatives[0])
+    return _fold('|', clauses)
     # Task 2.7
 
 def _synthesize_for_all_except_model(model: Model) -> Formula:
@@ -280,12 +534,8 @@ def _synthesize_for_all_except_model(model: Model) -> Formula:
     """
     assert is_model(model)
     assert len(model.keys()) > 0
-    vars_list = list(model.keys())
-    clause = None
-    for v in vars_list:
-        lit = Formula('~', Formula(v)) if model[v] else Formula(v)
-        clause = lit if clause is None else Formula('|', clause, lit)
-    return clause
+    return _fold('|', [Formula('~', Formula(v)) if model[v] else Formula(v)
+                       for v in model.keys()])
     # Optional Task 2.8
 
 def synthesize_cnf(variables: Sequence[str], values: Iterable[bool]) -> Formula:
@@ -311,18 +561,17 @@ def synthesize_cnf(variables: Sequence[str], values: Iterable[bool]) -> Formula:
         False
     """
     assert len(variables) > 0
-    models = list(all_models(variables))
-    clauses = []
-    for model, val in zip(models, values):
-        if not val:
-            clauses.append(_synthesize_for_all_except_model(model))
+    n = len(variables)
+    positives = [Formula(v) for v in variables]
+    negatives = [Formula('~', literal) for literal in positives]
+    # Variable number j is True in the i-th model if and only if bit number
+    # n-1-j of i is set.
+    clauses = [_fold('|', [negatives[j] if (i >> (n - 1 - j)) & 1
+                           else positives[j] for j in range(n)])
+               for i, val in zip(range(1 << n), values) if not val]
     if not clauses:
-        v = variables[0]
-        return Formula('|', Formula(v), Formula('~', Formula(v)))
-    f = clauses[0]
-    for c in clauses[1:]:
-        f = Formula('&', f, c)
-    return f
+        return Formula('|', positives[0], negatives[0])
+    return _fold('&', clauses)
     # Optional Task 2.9
 
 def evaluate_inference(rule: InferenceRule, model: Model) -> bool:
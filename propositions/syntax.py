@@ -7,12 +7,20 @@
 """Syntactic handling of propositional formulas."""
 
 from __future__ import annotations
-from functools import lru_cache
-from typing import Mapping, Optional, Set, Tuple, Union
+from array import array
+import re
+from typing import Callable, FrozenSet, List, Mapping, Optional, Tuple, \
+    Union
+from weakref import WeakValueDictionary
 
-from logic_utils import frozen, memoized_parameterless_method
+from logic_utils import frozen
+
+#: The constants of propositional formulas.
+_CONSTANTS = frozenset({'T', 'F'})
+
+#: The binary operators of propositional formulas.
+_BINARY_OPERATORS = frozenset({'&', '|', '->', '+', '<->', '-&', '-|'})
 
-@lru_cache(maxsize=100) # Cache the return value of is_variable
 def is_variable(string: str) -> bool:
     """Checks if the given string is a variable name.
 
@@ -22,10 +30,10 @@ def is_variable(string: str) -> bool:
     Returns:
         ``True`` if the given string is a variable name, ``False`` otherwise.
     """
-    return string[0] >= 'p' and string[0] <= 'z' and \
-           (len(string) == 1 or string[1:].isdecimal())
+    if len(string) == 1:
+        return 'p' <= string <= 'z'
+    return 'p' <= string[0] <= 'z' and string[1:].isdecimal()
 
-@lru_cache(maxsize=100) # Cache the return value of is_constant
 def is_constant(string: str) -> bool:
     """Checks if the given string is a constant.
 
@@ -35,9 +43,8 @@ def is_constant(string: str) -> bool:
     Returns:
         ``True`` if the given string is a constant, ``False`` otherwise.
     """
-    return string == 'T' or string == 'F'
+    return string in _CONSTANTS
 
-@lru_cache(maxsize=100) # Cache the return value of is_unary
 def is_unary(string: str) -> bool:
     """Checks if the given string is a unary operator.
 
@@ -49,7 +56,6 @@ def is_unary(string: str) -> bool:
     """
     return string == '~'
 
-@lru_cache(maxsize=100) # Cache the return value of is_binary
 def is_binary(string: str) -> bool:
     """Checks if the given string is a binary operator.
 
@@ -59,10 +65,151 @@ def is_binary(string: str) -> bool:
     Returns:
         ``True`` if the given string is a binary operator, ``False`` otherwise.
     """
-    return string in {'&', '|', '->', '+', '<->', '-&', '-|'}
+    return string in _BINARY_OPERATORS
     # For Chapter 3:
     # return string in {'&', '|',  '->', '+', '<->', '-&', '-|'}
 
+#: Mapping from each character that may start a formula representation to the
+#: kind of the token that it starts: ``'variable'``, ``'constant'``, ``'~'`` or
+#: ``'('``.
+_FIRST_CHARACTER_KINDS = {
+    **{chr(code): 'variable' for code in range(ord('p'), ord('z') + 1)},
+    'T': 'constant', 'F': 'constant', '~': '~', '(': '('}
+
+#: Mapping from the second character of each binary operator that starts with
+#: ``'-'`` to that operator.
+_BINARY_OPERATORS_AFTER_DASH = {'>': '->', '&': '-&', '|': '-|'}
+
+#: Pattern matching the digits that may follow the first letter of a variable
+#: name.
+_DIGITS_PATTERN = re.compile(r'\d*')
+
+def _binary_operator_at(string: str, position: int) -> Optional[str]:
+    """Finds the binary operator at the given position of the given string.
+
+    Parameters:
+        string: string to check.
+        position: position in the given string to check at.
+
+    Returns:
+        The binary operator that the given string has at the given position, or
+        ``None`` if there is none.
+    """
+    character = string[position:position + 1]
+    if character == '&' or character == '|' or character == '+':
+        return character
+    if character == '-':
+        return _BINARY_OPERATORS_AFTER_DASH.get(
+            string[position + 1:position + 2])
+    if character == '<' and string.startswith('<->', position):
+        return '<->'
+    return None
+
+def _operands(formula: Formula) -> Tuple[Formula, ...]:
+    """Finds the operands of the root of the given formula.
+
+    Parameters:
+        formula: formula to find the root operands of.
+
+    Returns:
+        The operands of the root of the given formula, in order.
+    """
+    if formula.first is None:
+        return ()
+    if formula.second is None:
+        return formula.first,
+    return formula.first, formula.second
+
+def _memoize_operands(formula: Formula, method: Callable[[Formula], object],
+                      slot_name: str) -> None:
+    """Calls the given memoizing parameterless method on all proper subformulas
+    of the given formula for which it was not called yet, operands before the
+    formulas that contain them, without recursion.
+
+    Parameters:
+        formula: formula whose proper subformulas to call the method on.
+        method: method of `Formula` that memoizes its return value in the
+            given slot, and that calls itself only on the operands of the root.
+        slot_name: name of the slot in which the given method memoizes its
+            return value.
+    """
+    stack = list(_operands(formula))
+    while len(stack) > 0:
+        node = stack[-1]
+        if hasattr(node, slot_name):
+            stack.pop()
+            continue
+        missing = [operand for operand in _operands(node)
+                   if not hasattr(operand, slot_name)]
+        if len(missing) > 0:
+            stack.extend(missing)
+            continue
+        stack.pop()
+        method(node)
+
+def _post_order(formula: Formula) -> List[Formula]:
+    """Lists the distinct node objects of the given formula, without recursion.
+
+    Parameters:
+        formula: formula to list the nodes of.
+
+    Returns:
+        The distinct node objects of the given formula, each listed once and
+        after all nodes in its subtree, so that the given formula is last.
+    """
+    nodes = []
+    listed = set()
+    stack = [(formula, False)]
+    while len(stack) > 0:
+        node, expanded = stack.pop()
+        if id(node) in listed:
+            continue
+        if not expanded:
+            stack.append((node, True))
+            stack.extend((operand, False)
+                         for operand in reversed(_operands(node)))
+            continue
+        listed.add(id(node))
+        nodes.append(node)
+    return nodes
+
+def _instantiator(template: Formula) -> \
+        Callable[[Optional[Formula], Optional[Formula]], Formula]:
+    """Prepares the given template for repeated instantiation.
+
+    Parameters:
+        template: formula over the variable names ``'p'`` and ``'q'`` to
+            prepare.
+
+    Returns:
+        A function that, given a first and a second operand, returns the
+        given template with every occurrence of ``'p'`` substituted with the
+        first operand and every occurrence of ``'q'`` substituted with the
+        second, except that occurrences of a variable name whose operand is
+        ``None`` are kept as they are.
+    """
+    nodes = _post_order(template)
+    def instantiate(first: Optional[Formula],
+                    second: Optional[Formula]) -> Formula:
+        built = {}
+        for node in nodes:
+            if node.root == 'p' and first is not None:
+                built[id(node)] = first
+            elif node.root == 'q' and second is not None:
+                built[id(node)] = second
+            elif node.first is None:
+                built[id(node)] = node
+            else:
+                built[id(node)] = Formula(
+                    node.root, built[id(node.first)],
+                    None if node.second is None else built[id(node.second)])
+        return built[id(template)]
+    return instantiate
+
+#: Interned variable and constant formulas, by root, so that all live formulas
+#: with the same variable or constant at their root share a single instance.
+_LEAF_CACHE: WeakValueDictionary = WeakValueDictionary()
+
 @frozen
 class Formula:
     """An immutable propositional formula in tree representation, composed from
@@ -80,6 +227,46 @@ class Formula:
     first: Optional[Formula]
     second: Optional[Formula]
 
+    # The slots prefixed with '_' memoize the return values of the methods of
+    # the same name, and are assigned only once these are first called.
+    __slots__ = ('root', 'first', 'second', '_hash', '_repr', '_variables',
+                 '_operators', '_flatten', '__weakref__')
+
+    def __new__(cls, root: str, first: Optional[Formula] = None,
+                second: Optional[Formula] = None) -> Formula:
+        """Allocates a `Formula`, reusing the live instance for the given root
+        if it is a variable name or a constant.
+
+        Parameters:
+            root: the root for the formula tree.
+            first: the first operand for the root, if the root is a unary or
+                binary operator.
+            second: the second operand for the root, if the root is a binary
+                operator.
+
+        Returns:
+            The interned formula for the given root if it is a variable name
+            or a constant, or a freshly allocated formula otherwise.
+        """
+        if first is None and second is None and \
+           (is_variable(root) or is_constant(root)):
+            leaf = _LEAF_CACHE.get(root)
+            if leaf is None:
+                leaf = _LEAF_CACHE[root] = super().__new__(cls)
+            return leaf
+        return super().__new__(cls)
+
+    def __reduce__(self) -> Tuple[type, Tuple[str, Optional[Formula],
+                                              Optional[Formula]]]:
+        """Describes how to copy or pickle the current formula.
+
+        Returns:
+            The `Formula` class and the arguments from which to construct a
+            copy of the current formula, so that copies are interned like any
+            other formula.
+        """
+        return Formula, (self.root, self.first, self.second)
+
     def __init__(self, root: str, first: Optional[Formula] = None,
                  second: Optional[Formula] = None):
         """Initializes a `Formula` from its root and root operands.
@@ -93,27 +280,44 @@ class Formula:
         """
         if is_variable(root) or is_constant(root):
             assert first is None and second is None
-            self.root = root
+            self.root, self.first, self.second = root, None, None
         elif is_unary(root):
             assert first is not None and second is None
-            self.root, self.first = root, first
+            self.root, self.first, self.second = root, first, None
         else:
             assert is_binary(root)
             assert first is not None and second is not None
             self.root, self.first, self.second = root, first, second
 
-    @memoized_parameterless_method
     def __repr__(self) -> str:
         """Computes the string representation of the current formula.
 
         Returns:
             The standard string representation of the current formula.
         """
-        if is_variable(self.root) or is_constant(self.root):
-            return self.root
-        if is_unary(self.root):
-            return self.root + str(getattr(self, 'first'))
-        return '(' + str(getattr(self, 'first')) + self.root + str(getattr(self, 'second')) + ')'
+        try:
+            return self._repr
+        except AttributeError:
+            pass
+        # The stack holds formulas still to be written and strings to be
+        # emitted as they are, with the next one to handle at its top.
+        parts = []
+        stack = [self]
+        while len(stack) > 0:
+            item = stack.pop()
+            if isinstance(item, str):
+                parts.append(item)
+            elif is_variable(item.root) or is_constant(item.root):
+                parts.append(item.root)
+            elif is_unary(item.root):
+                parts.append(item.root)
+                stack.append(item.first)
+            else:
+                parts.append('(')
+                stack.extend((')', item.second, item.root, item.first))
+        result = ''.join(parts)
+        object.__setattr__(self, '_repr', result)
+        return result
         # Task 1.1
 
     def __eq__(self, other: object) -> bool:
@@ -126,7 +330,33 @@ class Formula:
             ``True`` if the given object is a `Formula` object that equals the
             current formula, ``False`` otherwise.
         """
-        return isinstance(other, Formula) and str(self) == str(other)
+        if self is other:
+            return True
+        if not isinstance(other, Formula):
+            return False
+        # Hashes and string representations, once cached in both formulas,
+        # decide equality without walking them.
+        try:
+            if self._hash != other._hash:
+                return False
+        except AttributeError:
+            pass
+        try:
+            return self._repr == other._repr
+        except AttributeError:
+            pass
+        pairs = [(self, other)]
+        while len(pairs) > 0:
+            first, second = pairs.pop()
+            if first is second:
+                continue
+            if first.root != second.root:
+                return False
+            if is_binary(first.root):
+                pairs.append((first.second, second.second))
+            if is_unary(first.root) or is_binary(first.root):
+                pairs.append((first.first, second.first))
+        return True
 
     def __ne__(self, other: object) -> bool:
         """Compares the current formula with the given one.
@@ -141,57 +371,83 @@ class Formula:
         return not self == other
 
     def __hash__(self) -> int:
-        return hash(str(self))
-
-    @memoized_parameterless_method
-    def variables(self) -> Set[str]:
+        try:
+            return self._hash
+        except AttributeError:
+            pass
+        _memoize_operands(self, Formula.__hash__, '_hash')
+        result = hash((self.root,) + tuple(operand._hash
+                                           for operand in _operands(self)))
+        object.__setattr__(self, '_hash', result)
+        return result
+
+    def variables(self) -> FrozenSet[str]:
         """Finds all variable names in the current formula.
 
         Returns:
             A set of all variable names used in the current formula.
         """
-        res: Set[str] = set()
-        def walk(node: 'Formula'):
-            if node is None:
-                return
-            root = node.root
-            if is_variable(root):
-                res.add(root)
-                return
-            if is_constant(root):
-                return
-            left = getattr(node, 'first', None)
-            right = getattr(node, 'second', None)
-            walk(left)
-            walk(right)
-        walk(self)
-        return res
+        try:
+            return self._variables
+        except AttributeError:
+            pass
+        # A single walk, with the result cached only in the current formula:
+        # caching the sets of all subformulas would take quadratic time and
+        # memory on long chains of distinct variable names.
+        result = frozenset(node.root for node in _post_order(self)
+                           if is_variable(node.root))
+        object.__setattr__(self, '_variables', result)
+        return result
         # Task 1.2
 
-    @memoized_parameterless_method
-    def operators(self) -> Set[str]:
+    def operators(self) -> FrozenSet[str]:
         """Finds all operators in the current formula.
 
         Returns:
             A set of all operators (including ``'T'`` and ``'F'``) used in the
             current formula.
         """
-        ops: Set[str] = set()
-        def walk(node: 'Formula'):
-            if node is None:
-                return
-            root = node.root
-            if is_constant(root):
-                ops.add(root)
-                return
-            if is_variable(root):
-                return
-            ops.add(root)
-            walk(getattr(node, 'first', None))
-            walk(getattr(node, 'second', None))
-        walk(self)
-        return ops
+        try:
+            return self._operators
+        except AttributeError:
+            pass
+        result = frozenset(node.root for node in _post_order(self)
+                           if not is_variable(node.root))
+        object.__setattr__(self, '_operators', result)
+        return result
         # Task 1.3
+
+    def flatten(self) -> Tuple[Tuple[str, ...], memoryview, memoryview]:
+        """Linearizes the current formula into parallel sequences, one entry
+        per distinct node object.
+
+        Returns:
+            A triple of the roots of the distinct node objects of the current
+            formula, listed in post-order so that the current formula is last,
+            and of two read-only sequences of integers that hold, at the
+            position of each node, the positions of its first and second
+            operands, or ``-1`` for operands that the node does not have.
+
+        Examples:
+            >>> roots, firsts, seconds = Formula.parse('~(p&p)').flatten()
+            >>> roots, list(firsts), list(seconds)
+            (('p', '&', '~'), [-1, 0, 1], [-1, 0, -1])
+        """
+        try:
+            return self._flatten
+        except AttributeError:
+            pass
+        nodes = _post_order(self)
+        positions = {id(node): position for position, node in enumerate(nodes)}
+        result = (tuple(node.root for node in nodes),
+                  memoryview(array('l', [-1 if node.first is None
+                                         else positions[id(node.first)]
+                                         for node in nodes])).toreadonly(),
+                  memoryview(array('l', [-1 if node.second is None
+                                         else positions[id(node.second)]
+                                         for node in nodes])).toreadonly())
+        object.__setattr__(self, '_flatten', result)
+        return result
         
     @staticmethod
     def _parse_prefix(string: str) -> Tuple[Union[Formula, None], str]:
@@ -210,37 +466,122 @@ class Formula:
             should be of ``None`` and an error message, where the error message
             is a string with some human-readable content.
         """
-        if string == "":
-            return None, "empty string"
-        first_ch = string[0]
-        if 'p' <= first_ch <= 'z':
-            i = 1
-            while i < len(string) and string[i].isdecimal():
-                i += 1
-            return Formula(string[:i]), string[i:]
-        if string[0] in ('T', 'F'):
-            return Formula(string[0]), string[1:]
-        if string[0] == '~':
-            child, rem = Formula._parse_prefix(string[1:])
-            if child is None:
-                return None, rem
-            return Formula('~', child), rem
-        if string[0] != '(':
-            return None, "expected '(', variable, constant or unary"
-        left, rem_after_left = Formula._parse_prefix(string[1:])
-        if left is None:
-            return None, rem_after_left
-        for op in ('<->', '->', '-&', '-|', '+', '&', '|'):
-            if rem_after_left.startswith(op):
-                right, rem_after_right = Formula._parse_prefix(rem_after_left[len(op):])
-                if right is None:
-                    return None, rem_after_right
-                if rem_after_right == "" or rem_after_right[0] != ')':
-                    return None, "missing closing ')'"
-                return Formula(op, left, right), rem_after_right[1:]
-        return None, "missing or invalid binary operator"
+        formula, end, error = Formula._parse_from(string, 0)
+        if formula is None:
+            return None, error
+        return formula, string[end:]
         # Task 1.4
 
+    @staticmethod
+    def _parse_from(string: str, start: int) -> \
+            Tuple[Optional[Formula], int, Optional[str]]:
+        """Parses a prefix of the given string, starting at the given position,
+        into a formula.
+
+        Parameters:
+            string: string to parse.
+            start: position in the given string at which to start parsing.
+
+        Returns:
+            A triple of the parsed formula, the position in the given string
+            right after its parsed prefix, as in `_parse_prefix`, and ``None``.
+            If no prefix of the given string starting at the given position is
+            a valid standard string representation of a formula, then the
+            returned triple is of ``None``, the position at which parsing
+            failed, and an error message. No substrings of the given string are
+            copied other than variable names, and nesting depth is not limited
+            by the Python recursion limit.
+        """
+        # Each pending entry is either '~' or '(' awaiting its (first) operand,
+        # or a pair of a first operand and a binary operator awaiting the
+        # second operand.
+        pending = []
+        position = start
+        while True:
+            if position == len(string):
+                return None, position, "empty string"
+            kind = _FIRST_CHARACTER_KINDS.get(string[position])
+            if kind is None:
+                return None, position, \
+                       "expected '(', variable, constant or unary"
+            if kind == '~' or kind == '(':
+                pending.append(kind)
+                position += 1
+                continue
+            if kind == 'variable':
+                end = _DIGITS_PATTERN.match(string, position + 1).end()
+            else:
+                end = position + 1
+            formula = Formula(string[position:end])
+            position = end
+            while len(pending) > 0:
+                awaiting = pending.pop()
+                if awaiting == '~':
+                    formula = Formula('~', formula)
+                elif awaiting == '(':
+                    operator = _binary_operator_at(string, position)
+                    if operator is None:
+                        return None, position, \
+                               "missing or invalid binary operator"
+                    pending.append((formula, operator))
+                    position += len(operator)
+                    break
+                else:
+                    if position == len(string) or string[position] != ')':
+                        return None, position, "missing closing ')'"
+                    left, op = awaiting
+                    formula = Formula(op, left, formula)
+                    position += 1
+            else:
+                return formula, position, None
+
+    @staticmethod
+    def _validate_from(string: str, start: int) -> int:
+        """Checks which prefix of the given string, starting at the given
+        position, is a valid representation of a formula, without constructing
+        that formula.
+
+        Parameters:
+            string: string to check.
+            start: position in the given string at which to start checking.
+
+        Returns:
+            The position in the given string right after the prefix that
+            `_parse_from` would parse, or ``-1`` if it would fail.
+        """
+        # Each pending entry is either '(' awaiting its first operand, or ')'
+        # awaiting the second operand of its binary operator.
+        pending = []
+        position = start
+        while True:
+            if position == len(string):
+                return -1
+            kind = _FIRST_CHARACTER_KINDS.get(string[position])
+            if kind is None:
+                return -1
+            if kind == '~' or kind == '(':
+                if kind == '(':
+                    pending.append('(')
+                position += 1
+                continue
+            if kind == 'variable':
+                position = _DIGITS_PATTERN.match(string, position + 1).end()
+            else:
+                position += 1
+            while len(pending) > 0:
+                if pending.pop() == '(':
+                    operator = _binary_operator_at(string, position)
+                    if operator is None:
+                        return -1
+                    pending.append(')')
+                    position += len(operator)
+                    break
+                if position == len(string) or string[position] != ')':
+                    return -1
+                position += 1
+            else:
+                return position
+
     @staticmethod
     def is_formula(string: str) -> bool:
         """Checks if the given string is a valid representation of a formula.
@@ -252,8 +593,7 @@ class Formula:
             ``True`` if the given string is a valid standard string
             representation of a formula, ``False`` otherwise.
         """
-        parsed, rem = Formula._parse_prefix(string)
-        return parsed is not None and rem == ""
+        return Formula._validate_from(string, 0) == len(string)
         # Task 1.5
         
     @staticmethod
@@ -266,8 +606,8 @@ class Formula:
         Returns:
             A formula whose standard string representation is the given string.
         """
-        assert Formula.is_formula(string)
-        parsed, rem = Formula._parse_prefix(string)
+        parsed, end, _ = Formula._parse_from(string, 0)
+        assert parsed is not None and end == len(string)
         return parsed
         # Task 1.6
 
@@ -277,11 +617,16 @@ class Formula:
         Returns:
             The polish notation representation of the current formula.
         """
-        if is_variable(self.root) or is_constant(self.root):
-            return self.root
-        if is_unary(self.root):
-            return self.root + self.first.polish()
-        return self.root + self.first.polish() + self.second.polish()
+        parts = []
+        stack = [self]
+        while len(stack) > 0:
+            node = stack.pop()
+            parts.append(node.root)
+            if is_binary(node.root):
+                stack.extend((node.second, node.first))
+            elif is_unary(node.root):
+                stack.append(node.first)
+        return ''.join(parts)
         # Optional Task 1.7
 
     @staticmethod
@@ -301,32 +646,24 @@ class Formula:
             if i >= len(string):
                 raise ValueError("unexpected end")
 
-            ch = string[i]
-
-            if ch in ('T', 'F'):
-                return Formula(ch), i + 1
-
-            if 'p' <= ch <= 'z':
-                j = i + 1
-                while j < len(string) and string[j].isdecimal():
-                    j += 1
+            kind = _FIRST_CHARACTER_KINDS.get(string[i])
+            if kind == 'variable':
+                j = _DIGITS_PATTERN.match(string, i + 1).end()
                 return Formula(string[i:j]), j
 
-            if ch == '~':
-                sub, j = parse_from(i + 1)
-                return Formula('~', sub), j
-
-            if ch in ('&', '|'):
-                left, j = parse_from(i + 1)
-                right, k = parse_from(j)
-                return Formula(ch, left, right), k
+            if kind == 'constant':
+                return Formula(string[i]), i + 1
 
-            if string.startswith('->', i):
-                left, j = parse_from(i + 2)
-                right, k = parse_from(j)
-                return Formula('->', left, right), k
+            if kind == '~':
+                sub, k = parse_from(i + 1)
+                return Formula('~', sub), k
 
-            raise ValueError("invalid polish string")
+            token = _binary_operator_at(string, i)
+            if token is None:
+                raise ValueError("invalid polish string")
+            left, k = parse_from(i + len(token))
+            right, l = parse_from(k)
+            return Formula(token, left, right), l
 
         formula, pos = parse_from(0)
         if pos != len(string):
@@ -334,6 +671,28 @@ class Formula:
         return formula
         # Optional Task 1.8
 
+    def rebuild(self, rebuild_node: Callable[[Formula, Optional[Formula],
+                                              Optional[Formula]], Formula]) \
+            -> Formula:
+        """Rebuilds the current formula bottom-up, without recursion.
+
+        Parameters:
+            rebuild_node: function that rebuilds a node of the current formula,
+                given that node and the already rebuilt operands of its root
+                (``None`` for operands that the root does not have).
+
+        Returns:
+            The rebuilt formula. Every distinct node object of the current
+            formula is rebuilt only once, even if it occurs more than once in
+            the formula.
+        """
+        built = {}
+        for node in _post_order(self):
+            built[id(node)] = rebuild_node(
+                node, None if node.first is None else built[id(node.first)],
+                None if node.second is None else built[id(node.second)])
+        return built[id(self)]
+
     def substitute_variables(self, substitution_map: Mapping[str, Formula]) -> \
             Formula:
         """Substitutes in the current formula, each variable name `v` that is a
@@ -357,15 +716,21 @@ class Formula:
         """
         for variable in substitution_map:
             assert is_variable(variable)
-        if is_variable(self.root):
-            return substitution_map[self.root] if self.root in substitution_map else Formula(self.root)
-        if is_constant(self.root):
-            return Formula(self.root)
-        if is_unary(self.root):
-            return Formula(self.root, self.first.substitute_variables(substitution_map))
-        return Formula(self.root,
-                    self.first.substitute_variables(substitution_map),
-                    self.second.substitute_variables(substitution_map))
+        # If the variable names of the current formula are already known, a
+        # substitution that touches none of them is skipped without a walk.
+        try:
+            if self._variables.isdisjoint(substitution_map):
+                return self
+        except AttributeError:
+            pass
+        def substitute(node: Formula, first: Optional[Formula],
+                       second: Optional[Formula]) -> Formula:
+            if is_variable(node.root):
+                return substitution_map.get(node.root, node)
+            if first is node.first and second is node.second:
+                return node
+            return Formula(node.root, first, second)
+        return self.rebuild(substitute)
         # Task 3.3
 
     def substitute_operators(self, substitution_map: Mapping[str, Formula]) -> \
@@ -393,36 +758,25 @@ class Formula:
             ~(~~(~x|~y)|~~z)
         """
         for operator in substitution_map:
-            assert is_constant(operator) or is_unary(operator) or is_binary(operator)
+            assert is_constant(operator) or is_unary(operator) or \
+                   is_binary(operator)
             assert substitution_map[operator].variables().issubset({'p', 'q'})
-        def replace_template(template: Formula, p_formula: Formula, q_formula: Formula) -> Formula:
-            if is_variable(template.root):
-                if template.root == 'p':
-                    return p_formula if p_formula is not None else Formula('p')
-                if template.root == 'q':
-                    return q_formula if q_formula is not None else Formula('q')
-                return Formula(template.root)
-            if is_constant(template.root):
-                return Formula(template.root)
-            if is_unary(template.root):
-                return Formula(template.root, replace_template(template.first, p_formula, q_formula))
-            return Formula(template.root,
-                        replace_template(template.first, p_formula, q_formula),
-                        replace_template(template.second, p_formula, q_formula))
-        if is_variable(self.root):
-            return Formula(self.root)
-        if is_constant(self.root):
-            if self.root in substitution_map:
-                return replace_template(substitution_map[self.root], None, None)
-            return Formula(self.root)
-        if is_unary(self.root):
-            new_child = self.first.substitute_operators(substitution_map)
-            if self.root in substitution_map:
-                return replace_template(substitution_map[self.root], new_child, None)
-            return Formula(self.root, new_child)
-        new_first = self.first.substitute_operators(substitution_map)
-        new_second = self.second.substitute_operators(substitution_map)
-        if self.root in substitution_map:
-            return replace_template(substitution_map[self.root], new_first, new_second)
-        return Formula(self.root, new_first, new_second)
+        instantiators = {operator: _instantiator(substitution_map[operator])
+                         for operator in substitution_map}
+        # Instantiations by operator and rebuilt operands, so that copies of
+        # a subformula that are distinct objects are still expanded only once.
+        instantiated = {}
+        def substitute(node: Formula, first: Optional[Formula],
+                       second: Optional[Formula]) -> Formula:
+            instantiator = instantiators.get(node.root)
+            if instantiator is not None:
+                key = (node.root, id(first), id(second))
+                result = instantiated.get(key)
+                if result is None:
+                    result = instantiated[key] = instantiator(first, second)
+                return result
+            if first is node.first and second is node.second:
+                return node
+            return Formula(node.root, first, second)
+        return self.rebuild(substitute)
         # Task 3.4
@@ -6,6 +6,10 @@
 
 """Tests for the propositions.syntax module."""
 
+import copy
+import pickle
+import sys
+
 from logic_utils import frozendict
 
 from propositions.syntax import *
@@ -53,6 +57,16 @@ def test_variables(debug=False):
             print('Testing variables of', formula)
         assert formula.variables() == expected_variables
 
+def test_variables_of_long_chain(debug=False):
+    n = 20000
+    if debug:
+        print('Testing variables of a conjunction of', n, 'variable names')
+    f = Formula('x1')
+    for i in range(2, n + 1):
+        f = Formula('&', f, Formula('x' + str(i)))
+    assert f.variables() == {'x' + str(i) for i in range(1, n + 1)}
+    assert f.operators() == {'&'}
+
 def test_operators(debug=False):
     for f, ops in [(Formula('T'), {'T'}),
                    (Formula('x1234'), set()),
@@ -276,6 +290,24 @@ def test_parse_all_operators(debug=False):
         assert type(ff) is Formula
         assert str(ff) == f
 
+def test_parse_polish_all_operators(debug=False):
+    for polish, infix in [('<->p-&qr', '(p<->(q-&r))'),
+                          ('+~x-|yT', '(~x+(y-|T))'),
+                          ('->&p1q-|F~r', '((p1&q)->(F-|~r))')]:
+        if debug:
+            print("Testing polish parsing of formula", polish)
+        f = Formula.parse_polish(polish)
+        assert str(f) == infix
+        assert f.polish() == polish
+    for polish in ['<-pq', '-pq', '<->p', '+p']:
+        if debug:
+            print("Testing polish parsing of invalid formula", polish)
+        try:
+            Formula.parse_polish(polish)
+            assert False, "parse_polish accepted " + polish
+        except ValueError:
+            pass
+
 def test_substitute_variables(debug=False):
     #           f         d              result
     tests = [ ('v',       {},             'v'),
@@ -321,13 +353,37 @@ def test_substitute_operators(debug=False):
         a = str(f.substitute_operators(frozendict(d)))
         assert a == r, "Incorrect answer:"+a             
                
+def test_copy_and_pickle(debug=False):
+    for s in ['x12', 'T', '~~F', '(p|p)', '((p->q)->(~q->~p))']:
+        if debug:
+            print('Testing copying and pickling formula', s)
+        f = Formula.parse(s)
+        for c in [copy.copy(f), copy.deepcopy(f), pickle.loads(pickle.dumps(f))]:
+            assert c == f and str(c) == s and hash(c) == hash(f)
+            if is_variable(s) or is_constant(s):
+                assert c is f
+
+def test_deep_formula(debug=False):
+    depth = 2 * sys.getrecursionlimit()
+    if debug:
+        print('Testing a formula nested', depth, 'levels deep')
+    s = '(' * depth + 'p' + '&~q)' * depth
+    f = Formula.parse(s)
+    assert str(f) == s
+    g = Formula.parse(s)
+    assert f == g and hash(f) == hash(g)
+    assert f != Formula.parse(s[:-4] + '|~q)')
+
 def test_ex1(debug=False):
     test_repr(debug)
     test_variables(debug)
+    test_variables_of_long_chain(debug)
     test_operators(debug)
     test_parse_prefix(debug)
     test_is_formula(debug)
     test_parse(debug)
+    test_copy_and_pickle(debug)
+    test_deep_formula(debug)
     
 def test_ex1_opt(debug=False):
     test_polish(debug)
@@ -341,6 +397,7 @@ def test_ex3(debug=False):
     test_parse_prefix_all_operators(debug)
     test_is_formula_all_operators(debug)
     test_parse_all_operators(debug)    
+    test_parse_polish_all_operators(debug)
     test_substitute_variables(debug)
     test_substitute_operators(debug)
 